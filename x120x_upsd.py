@@ -10,8 +10,10 @@ It shuts down the pi when condfigured parameters are reached.
 """
 
 import configparser
+import glob
 import os
 import signal
+import statistics
 import smbus2
 import subprocess
 import systemd.daemon
@@ -41,7 +43,9 @@ config['DEFAULT'] = {
     'json_report_period': '0',
     'disable_self_protect': 'Off',
     'no_power_at_start': 'default',
-    'temperature_sensor_type': ''
+    'temperature_sensor_type': '',
+    'temperature_aggregation': 'max',
+    'temperature_poll_period': '30'
 }
 
 CONFIG_FILE = '/usr/local/etc/x120x_upsd.ini'
@@ -51,6 +55,9 @@ CHG_ONOFF_PIN = 16
 CHG_PRESENT_PIN = 6
 BUS_ADDRESS = 1
 BATTERY_ADDRESS = 0x36
+W1_DEVICES_PATH = '/sys/bus/w1/devices'
+THERMAL_ZONES_PATH = '/sys/class/thermal'
+MIN_TEMPERATURE_POLL_PERIOD = 2 # DHT sensors can't be read more often than every 2 seconds
 
 
 class TimerError(Exception):
@@ -229,7 +236,7 @@ class Battery:
                     'max_voltage': self.max_voltage,
                 }
         temp = self.temperature
-        if temp:
+        if temp != None:
             report.update({'battery_temperature': temp})
         if self._fan != None:
             report.update({'fan_state': self._fan.state})
@@ -266,7 +273,7 @@ class Battery:
                 f'It {"needs" if self.needs_charging() else "does not need"} charging. ' \
                 f'Charger is {"not " if not self._charger.present else ""}present.')
         temp = self.temperature
-        if temp:
+        if temp != None:
             message += f' Battery temperature is {temp:0.1f}�C. '
         if self._do_not_charge:
             message += f' Charging is currently not allowed. '
@@ -532,16 +539,17 @@ class adafruit_dht_sensor:
             except Exception as error:
                 pass
             self._sensor = None
-#            raise error
+            raise ValueError(f'unable to set up {sensor_type} on GPIO{gpio_pin}: {error}')
 
     @property
     def temperature(self):
+        if self._sensor == None:
+            return None
         for _ in range(10):
             try:
                 temperature_c = self._sensor.temperature
             except RuntimeError as error:
                 # Apparently errors happen fairly often, DHT's are hard to read. We try 10 times, for luck.
-                print('Unable to read temperature sensor. Retrying', flush=True)
                 time.sleep(0.5)
                 continue
             else:
@@ -558,20 +566,202 @@ class adafruit_dht_sensor:
             else:
                 self._sensor = None
 
-def get_temp_sensor(TEMPERATURE_SENSOR_TYPE):
-    sensor = None
-    if TEMPERATURE_SENSOR_TYPE.split(',')[0] in ('DHT22', 'DHT11'):
-        sensor_type, gpio_pin, pull_up = TEMPERATURE_SENSOR_TYPE.split(',')
-        sensor = adafruit_dht_sensor(sensor_type, gpio_pin, pull_up)
-        if sensor:
-            # test to see if the sensor is working
+class ds18b20_sensor:
+    '''DS18B20 read through the kernel w1 sysfs interface (w1-gpio and w1-therm overlays).'''
+    def __init__(self, sensor_type, device_id=''):
+        self._sensor_type = sensor_type
+        device_id = device_id.strip()
+        if device_id in ('', 'auto'):
+            # DS18B20 family code is 28, take the first one found
+            devices = sorted(glob.glob(os.path.join(W1_DEVICES_PATH, '28-*')))
+            if not devices:
+                raise ValueError(f'no DS18B20 found in {W1_DEVICES_PATH}')
+            device_id = os.path.basename(devices[0])
+        self._device_path = os.path.join(W1_DEVICES_PATH, device_id)
+        if not os.path.isfile(os.path.join(self._device_path, 'w1_slave')):
+            raise ValueError(f'DS18B20 {device_id} not found in {W1_DEVICES_PATH}')
+        self._last_temperature = None
+
+    @property
+    def temperature(self):
+        try:
+            # Reading w1_slave triggers a conversion, the kernel blocks up to 750ms for it.
+            with open(os.path.join(self._device_path, 'w1_slave')) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        if len(lines) < 2 or not lines[0].endswith('YES') or 't=' not in lines[1]:
+            # CRC check failed or incomplete read
+            return None
+        try:
+            temperature_c = int(lines[1].split('t=')[1]) / 1000
+        except (ValueError, IndexError):
+            return None
+        if temperature_c == 85 and (self._last_temperature == None or abs(self._last_temperature - 85) > 10):
+            # 85C is the power-on reset value, no conversion was done. Unless the
+            # cells were already getting that hot, then it is a real reading.
+            return None
+        self._last_temperature = temperature_c
+        return temperature_c
+
+    def release_sensor(self):
+        pass
+
+
+class thermal_zone_sensor:
+    '''Linux thermal zone, either by name (thermal_zone1) or by type.'''
+    def __init__(self, sensor_type, zone=''):
+        self._sensor_type = sensor_type
+        zone = zone.strip()
+        if zone == '':
+            # No default, the first zone on a Pi is the SoC and not the battery.
+            raise ValueError('no thermal zone given')
+        if zone.isdigit():
+            zone = 'thermal_zone' + zone
+        self._zone_path = None
+        if os.path.isdir(os.path.join(THERMAL_ZONES_PATH, zone)):
+            self._zone_path = os.path.join(THERMAL_ZONES_PATH, zone)
+        else:
+            for path in sorted(glob.glob(os.path.join(THERMAL_ZONES_PATH, 'thermal_zone*'))):
+                try:
+                    with open(os.path.join(path, 'type')) as f:
+                        if f.read().strip() == zone:
+                            self._zone_path = path
+                            break
+                except OSError:
+                    continue
+        if self._zone_path == None:
+            raise ValueError(f'thermal zone {zone} not found in {THERMAL_ZONES_PATH}')
+
+    @property
+    def temperature(self):
+        try:
+            with open(os.path.join(self._zone_path, 'temp')) as f:
+                return int(f.read().strip()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    def release_sensor(self):
+        pass
+
+
+TEMPERATURE_SENSORS = {
+    'DHT22': adafruit_dht_sensor,
+    'DHT11': adafruit_dht_sensor,
+    'DS18B20': ds18b20_sensor,
+    'THERMAL': thermal_zone_sensor,
+}
+
+TEMPERATURE_AGGREGATIONS = {
+    'max': max,
+    'median': statistics.median,
+}
+
+
+class temperature_sensors:
+    '''
+    Combines one or more sensors into one temperature.
+    The sensors are read in a background thread, so reading the temperature
+    only returns the last aggregated value and never waits for a sensor.
+    sensors is a list of (name, sensor) pairs, the name is used for logging.
+    '''
+    def __init__(self, sensors, aggregation='max', poll_period=30):
+        self._sensors = sensors
+        aggregation = aggregation.strip().lower()
+        if aggregation not in TEMPERATURE_AGGREGATIONS:
+            print(f'Warning: temperature_aggregation value "{aggregation}" is not implemented. Using "max" as fall-back.', flush=True)
+            aggregation = 'max'
+        self._aggregate = TEMPERATURE_AGGREGATIONS[aggregation]
+        if poll_period < MIN_TEMPERATURE_POLL_PERIOD:
+            print(f'Warning: temperature_poll_period {poll_period} is too short. Using {MIN_TEMPERATURE_POLL_PERIOD} seconds.', flush=True)
+            poll_period = MIN_TEMPERATURE_POLL_PERIOD
+        self._poll_period = poll_period
+        # A reading older than this is not trusted. Leaves room for slow sensors, like DHT retries.
+        self._max_age = 3 * poll_period + 10
+        self._temperature = None
+        self._read_time = None
+        self._failing = set()
+        self._poll_thread = None
+
+    @property
+    def temperature(self):
+        if self._read_time == None or time.monotonic() - self._read_time > self._max_age:
+            return None
+        return self._temperature
+
+    def _read_sensor(self, name, sensor):
+        reason = ''
+        try:
             t = sensor.temperature
-            if t == None:
-                sensor = None
-                print('Sensor not working')
-            else:
-                print('Sensor working')
-                print('Temperature:', t)
+        except Exception as error:
+            t = None
+            reason = f': {error}'
+        # Only log changes, so a broken sensor does not flood the journal.
+        if t == None and name not in self._failing:
+            self._failing.add(name)
+            print(f'Temperature sensor {name} is not working{reason}', flush=True)
+        elif t != None and name in self._failing:
+            self._failing.discard(name)
+            print(f'Temperature sensor {name} is working again', flush=True)
+        return t
+
+    def read_sensors(self):
+        readings = [t for t in (self._read_sensor(name, sensor) for name, sensor in self._sensors) if t != None]
+        self._temperature = self._aggregate(readings) if readings else None
+        self._read_time = time.monotonic()
+        return self._temperature
+
+    def _poll(self):
+        while not self._stop_poll.wait(self._poll_period):
+            self.read_sensors()
+
+    def start_polling(self):
+        if not(self._poll_thread and self._poll_thread.is_alive()):
+            self._stop_poll = Event()
+            self._poll_thread = Thread(target=self._poll, daemon=True)
+            self._poll_thread.start()
+
+    def stop_polling(self):
+        if self._poll_thread and self._poll_thread.is_alive():
+            self._stop_poll.set()
+            self._poll_thread.join()
+
+    def release_sensor(self):
+        self.stop_polling()
+        for _, sensor in self._sensors:
+            sensor.release_sensor()
+
+
+def get_temp_sensor(TEMPERATURE_SENSOR_TYPE, aggregation='max', poll_period=30):
+    sensors = []
+    ds18b20_auto = False
+    for sensor_config in TEMPERATURE_SENSOR_TYPE.split(';'):
+        sensor_config = sensor_config.strip()
+        args = [arg.strip() for arg in sensor_config.split(',')]
+        if args[0] == 'DS18B20' and (len(args) < 2 or args[1] in ('', 'auto')):
+            if ds18b20_auto:
+                # It would find the same device again and read one sensor twice.
+                print(f'Ignoring temperature sensor {sensor_config}: only one DS18B20 without a device id is allowed', flush=True)
+                continue
+            ds18b20_auto = True
+        if args[0] in TEMPERATURE_SENSORS:
+            try:
+                sensors.append((sensor_config, TEMPERATURE_SENSORS[args[0]](*args)))
+            except Exception as error:
+                print(f'Unable to set up temperature sensor {sensor_config}: {error}', flush=True)
+        elif args[0] != '':
+            print(f'Unknown temperature sensor type {args[0]}', flush=True)
+    if not sensors:
+        return None
+    sensor = temperature_sensors(sensors, aggregation=aggregation, poll_period=poll_period)
+    # test to see if the sensor is working. A failed read is not fatal, the poller keeps trying.
+    t = sensor.read_sensors()
+    if t == None:
+        print('Sensor not working yet, will keep trying', flush=True)
+    else:
+        print('Sensor working')
+        print('Temperature:', t)
+    sensor.start_polling()
     return sensor
 
 if __name__ == '__main__':
@@ -591,6 +781,8 @@ if __name__ == '__main__':
     JSON_REPORT_FILE        = config['general'].get('json_report_file').strip().strip('"')
     JSON_REPORT_PERIOD      = config['general'].getint('json_report_period')
     TEMPERATURE_SENSOR_TYPE = config['general'].get('temperature_sensor_type')
+    TEMPERATURE_AGGREGATION = config['general'].get('temperature_aggregation')
+    TEMPERATURE_POLL_PERIOD = config['general'].getint('temperature_poll_period')
     # Ensure only one instance of the script is running
     if PIDFILE != '':
         pid = str(os.getpid())
@@ -603,7 +795,8 @@ if __name__ == '__main__':
 
     try:
         stopsignal = GracefullKiller()
-        temperature_sensor = get_temp_sensor(TEMPERATURE_SENSOR_TYPE)
+        temperature_sensor = get_temp_sensor(TEMPERATURE_SENSOR_TYPE, aggregation=TEMPERATURE_AGGREGATION, \
+                                             poll_period=TEMPERATURE_POLL_PERIOD)
         charger = Charger(CHG_ONOFF_PIN, CHG_PRESENT_PIN)
         fan = SystemFan()
         battery = Battery(BUS_ADDRESS, BATTERY_ADDRESS, charger, max_voltage=MAX_VOLTAGE, \